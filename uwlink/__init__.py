@@ -1,7 +1,14 @@
-from flask import Flask
+import datetime
+import functools
+import types
+
+import orjson
+from flask import Flask, Request, Response
 from flask_mongoengine import MongoEngine
 from flask_bootstrap import Bootstrap
 from flask_login import LoginManager
+from werkzeug.http import http_date
+from uwlink.sessions import CachedSessionInterface
 
 # MongoEngine is a library for easily working with MongoDB from Python. The classes in uwlink/models.py
 # correspond to separate MongoDB collections (automatically created if not exists) and instances of those classes
@@ -20,8 +27,47 @@ bootstrap = Bootstrap()
 
 login_manager = LoginManager()
 
+
+# Called by orjson for anything it can't serialize itself. Models (see uwlink/models.py) whose to_dict needs no extra
+# data, like Pet, can be passed to jsonify directly, and ObjectIds become strings. An Owner needs its pets, which means
+# a query, so it has to be converted by the caller - passing one here fails rather than querying MongoDB mid-dump
+#
+# Dates and datetimes are passed through to here as well, to keep the HTTP date format that Flask's jsonify used (e.g.
+# "Wed, 14 Oct 2026 13:32:59 GMT") rather than orjson's ISO 8601 format
+def _default(obj):
+    if isinstance(obj, db.Document):
+        return obj.to_dict()
+    if isinstance(obj, datetime.datetime):
+        return http_date(obj.utctimetuple())
+    if isinstance(obj, datetime.date):
+        return http_date(obj.timetuple())
+    return str(obj)
+
+
+# Flask's own jsonify goes through the standard library json module, which is slow for the "get all" endpoints that
+# serialize a whole collection. orjson is a drop-in replacement written in C
+#
+# Flask 1.1 has no pluggable JSON provider (that was added in Flask 2.2), so routes use this jsonify instead. dumps is
+# bound once here rather than wrapped in a function, since the streaming endpoints call it for every document
+#
+# https://github.com/ijl/orjson
+dumps = functools.partial(orjson.dumps, default=_default,
+                          option=orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME)
+
+
+def jsonify(obj):
+    return Response(dumps(obj), mimetype='application/json')
+
+
+# Request bodies are parsed with orjson too, so request.get_json() in uwlink/routes.py works as usual. get_json looks
+# up loads on json_module, so swapping that leaves caching and error handling to Werkzeug
+class OrjsonRequest(Request):
+    json_module = types.SimpleNamespace(loads=orjson.loads, dumps=dumps)
+
+
 def create_app():
     app = Flask(__name__)
+    app.request_class = OrjsonRequest
 
     # Configure Flask to connect to our MongoDB cluster
     #
@@ -31,8 +77,21 @@ def create_app():
     # https://security.stackexchange.com/questions/184021/managing-db-credentials-for-web-applications
     mongo_username = 'admin'
     mongo_password = 'admin'
-    app.config['MONGODB_HOST'] = 'mongodb+srv://{}:{}@cluster0.ryror.mongodb.net/uwlink?retryWrites=true&w=majority'\
-        .format(mongo_username, mongo_password)
+    #
+    # The remaining settings tune pymongo's connection pool, fail fast rather than hang when the cluster is unreachable,
+    # and compress the traffic between the app and MongoDB
+    #
+    # https://pymongo.readthedocs.io/en/stable/api/pymongo/mongo_client.html
+    app.config['MONGODB_SETTINGS'] = {
+        'host': 'mongodb+srv://{}:{}@cluster0.ryror.mongodb.net/uwlink?retryWrites=true&w=majority'
+            .format(mongo_username, mongo_password),
+        'maxPoolSize': 200,
+        'minPoolSize': 10,
+        'socketTimeoutMS': 2000,
+        'connectTimeoutMS': 2000,
+        'serverSelectionTimeoutMS': 2000,
+        'compressors': 'zstd,zlib',
+    }
     db.init_app(app)
 
     bootstrap.init_app(app)
@@ -41,9 +100,16 @@ def create_app():
     #
     # This is used by Flask for various tasks, like signing cookies
     app.config['SECRET_KEY'] = 'a super secret key'
+    app.session_interface = CachedSessionInterface()
     login_manager.init_app(app)
 
     # Register the API endpoints we defined in uwlink/routes.py
     from uwlink.routes import routes
     app.register_blueprint(routes)
+
+    # MongoEngine creates indexes lazily on first use, so do it now instead of during the first signup. Then load the
+    # existing usernames for the signup form's bloom filter
+    from uwlink.models import Owner, load_known_usernames
+    Owner.ensure_indexes()
+    load_known_usernames()
     return app
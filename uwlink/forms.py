@@ -1,9 +1,15 @@
+import re
+
 from flask_wtf import FlaskForm
-from uwlink.models import Owner
+from uwlink.models import Owner, known_usernames
 from mongoengine import DoesNotExist
 from wtforms import StringField, PasswordField, BooleanField, SubmitField
 from wtforms.validators import DataRequired, Length, Regexp, EqualTo, ValidationError
 
+# \Z rather than $, since $ also matches before a trailing newline
+USERNAME_RE = re.compile(r'^[A-Za-z][A-Za-z0-9_.]*\Z')
+
+
 class LoginForm(FlaskForm):
     username = StringField('Username', validators=[DataRequired(), Length(1, 64)])
     password = PasswordField('Password', validators=[DataRequired()])
@@ -12,7 +18,7 @@ class LoginForm(FlaskForm):
 class SignupForm(FlaskForm):
     username = StringField('Username', validators=[
         DataRequired(), Length(1, 64),
-        Regexp('^[A-Za-z][A-Za-z0-9_.]*$', 0,
+        Regexp(USERNAME_RE, 0,
                'Usernames must have only letters, numbers, dots or '
                'underscores')])
     password = PasswordField('Password', validators=[
@@ -22,6 +28,9 @@ class SignupForm(FlaskForm):
 
     # Functions named validate_<field> will be called to validate a specific field
     def validate_username(self, field):
+        # Most usernames aren't taken, which the bloom filter can tell us without a database query
+        if field.data not in known_usernames:
+            return
         try:
             if Owner.objects.get(username=field.data):
                 raise ValidationError('Username already in use.')
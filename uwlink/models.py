@@ -1,3 +1,10 @@
+import datetime
+import threading
+from dataclasses import dataclass
+from typing import List, Optional
+
+from bson import ObjectId
+from pybloom_live import ScalableBloomFilter
 from uwlink import db
 
 # The model classes here (anything which inherits from db.Document) represent data stored in the database
@@ -5,40 +12,117 @@ from uwlink import db
 # Each class also has a to_dict method, which returns a dictionary of data that we intend to send back to the user in
 # API responses. Having this method decouples the schema of the database from the schema of the API responses
 #
+# to_dict reads the document's fields from self._data (where MongoEngine keeps them) rather than through each field's
+# descriptor
+#
+# The "get all" endpoints skip MongoEngine documents entirely. They read plain dicts straight from pymongo and convert
+# them with the OwnerData and PetData dataclasses at the bottom of this file, which orjson serializes natively
+#
 # I got this idea from UWFlow (which is also a Flask+MongoDB project)
 #
 # https://github.com/UWFlow/rmc/blob/00bcc1450ffbec3a6c8d956a2a5d1bb3a04bfcb9/models/course.py
 
 
 class Owner(db.Document):
+    # Owners used to store a list of their pets' ids, which grew without bound and had to be rewritten on every new
+    # pet. Old documents may still have that field, so don't fail when loading them
+    meta = {'strict': False}
+
     # Setting unique=True causes MongoEngine to create this collection with a unique index on this field
     #
     # https://docs.mongodb.com/manual/core/index-unique/
     username = db.StringField(unique=True)
-    pets = db.ListField(db.StringField())
     joined_at = db.DateTimeField()
 
-    # No need to include this in to_dict
+    # No need to include these in to_dict
     hashed_password = db.StringField()
+    # Incremented on logout, see User.get_id in uwlink/routes.py
+    session_generation = db.IntField(default=0)
 
-    def to_dict(self):
+    # An owner's pets are found through the index on Pet.owner_id, with a separate query. to_dict never runs that query
+    # itself, so callers always see it: use pet_ids for a single owner, or fetch the pets of many owners at once
+    def pet_ids(self):
+        return [str(p.id) for p in pets_of([self.id]).only('id')]
+
+    def to_dict(self, pets):
+        data = self._data
         return {
-            "owner_id": str(self.id),
-            "username": self.username,
-            "pets": self.pets,
-            "joined_at": self.joined_at
+            "owner_id": str(data['id']),
+            "username": data['username'],
+            "pets": pets,
+            "joined_at": data['joined_at']
         }
 
 
+# A bloom filter of all usernames which have been taken. It lets most new usernames skip the database query during
+# signup: if the filter has never seen a username, it is accepted without asking MongoDB. A bloom filter may say it
+# has seen a username when it hasn't (in which case we fall back to querying MongoDB), but never the opposite - except
+# for usernames taken by another process running the app since it started, which the unique index on Owner.username
+# still catches
+#
+# https://en.wikipedia.org/wiki/Bloom_filter
+known_usernames = ScalableBloomFilter(mode=ScalableBloomFilter.SMALL_SET_GROWTH)
+known_usernames_lock = threading.Lock()
+
+
+def add_known_username(username):
+    with known_usernames_lock:
+        known_usernames.add(username)
+
+
+def load_known_usernames():
+    for username in Owner.objects.scalar('username'):
+        add_known_username(username)
+
+
 class Pet(db.Document):
+    # Index owner_id so that looking up the pets of an owner doesn't scan the whole collection
+    #
+    # https://docs.mongoengine.org/guide/defining-documents.html#indexes
+    meta = {'indexes': ['owner_id']}
+
     name = db.StringField()
     type = db.StringField()
-    owner_id = db.StringField()
+    # Stored as an ObjectId (12 bytes) like the owner's own _id, rather than its 24 character hex string
+    owner_id = db.ObjectIdField()
 
     def to_dict(self):
+        data = self._data
         return {
-            "pet_id": str(self.id),
-            "name": self.name,
-            "type": self.type,
-            "owner_id": self.owner_id
+            "pet_id": str(data['id']),
+            "name": data['name'],
+            "type": data['type'],
+            "owner_id": None if data['owner_id'] is None else str(data['owner_id'])
         }
+
+
+# Pets saved before owner_id became an ObjectId still store it as a string, so match both until they are converted.
+# This needs __raw__, since MongoEngine would otherwise turn the strings back into ObjectIds
+def pets_of(owner_ids):
+    owner_ids = list(owner_ids)
+    return Pet.objects(__raw__={'owner_id': {'$in': owner_ids + [str(i) for i in owner_ids]}})
+
+
+# These have the same fields as the to_dict methods above, but are built from the raw dicts returned by pymongo
+@dataclass
+class OwnerData:
+    owner_id: ObjectId
+    username: Optional[str]
+    pets: List[str]
+    joined_at: Optional[datetime.datetime]
+
+    @classmethod
+    def from_pymongo(cls, doc, pets):
+        return cls(doc['_id'], doc.get('username'), pets, doc.get('joined_at'))
+
+
+@dataclass
+class PetData:
+    pet_id: ObjectId
+    name: Optional[str]
+    type: Optional[str]
+    owner_id: Optional[ObjectId]
+
+    @classmethod
+    def from_pymongo(cls, doc):
+        return cls(doc['_id'], doc.get('name'), doc.get('type'), doc.get('owner_id'))
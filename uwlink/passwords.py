@@ -0,0 +1,49 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from argon2 import PasswordHasher
+from argon2.exceptions import InvalidHash, VerificationError
+from werkzeug.security import check_password_hash
+
+# Passwords are hashed with Argon2id, which is designed to be slow for attackers while letting us tune its time and
+# memory cost. These parameters are the OWASP recommended minimum
+#
+# Owners who signed up before the switch still have Werkzeug (PBKDF2) hashes. Those are still accepted, and login
+# replaces them with an Argon2 hash once the password is verified
+#
+# https://cheatsheetseries.owasp.org/cheatsheets/Password_Storage_Cheat_Sheet.html#argon2id
+password_hasher = PasswordHasher(time_cost=2, memory_cost=19456, parallelism=1)
+
+ARGON2_PREFIX = '$argon2'
+
+# Hashing runs on a pool sized to the number of CPUs. Argon2 and hashlib release the GIL while hashing, so threads are
+# enough, and a burst of signups or logins queues up rather than running more hashes (each using 19 MiB) at once than
+# there are cores to run them
+hashing_pool = ThreadPoolExecutor(max_workers=os.cpu_count())
+
+
+def hash_password(password):
+    return hashing_pool.submit(_hash_password, password).result()
+
+
+def _hash_password(password):
+    return password_hasher.hash(password)
+
+
+def verify_password(hashed_password, password):
+    return hashing_pool.submit(_verify_password, hashed_password, password).result()
+
+
+def _verify_password(hashed_password, password):
+    if not hashed_password.startswith(ARGON2_PREFIX):
+        return check_password_hash(hashed_password, password)
+    try:
+        return password_hasher.verify(hashed_password, password)
+    except (VerificationError, InvalidHash):
+        return False
+
+
+def needs_rehash(hashed_password):
+    if not hashed_password.startswith(ARGON2_PREFIX):
+        return True
+    return password_hasher.check_needs_rehash(hashed_password)
@@ -1,12 +1,18 @@
 import datetime
-
-from flask import Blueprint, jsonify, request, render_template, flash, redirect, url_for
-from flask_login import UserMixin, current_user, login_required, login_user
-from mongoengine.errors import DoesNotExist
-from uwlink import login_manager
+import threading
+
+import bson
+import cachetools
+import cachetools.keys
+from bson import ObjectId
+from flask import (Blueprint, Response, abort, current_app, request, render_template, flash, redirect,
+                   session, stream_with_context, url_for)
+from flask_login import UserMixin, current_user, login_required, login_user, logout_user
+from mongoengine.errors import DoesNotExist, NotUniqueError
+from uwlink import dumps, jsonify, login_manager
 from uwlink.forms import LoginForm, SignupForm
-from uwlink.models import Owner, Pet
-from werkzeug.security import check_password_hash, generate_password_hash
+from uwlink.models import Owner, OwnerData, Pet, PetData, add_known_username, pets_of
+from uwlink.passwords import hash_password, needs_rehash, verify_password
 
 
 # In Flask, a blueprint is just a group of related routes (the functions below), it helps organize your code
@@ -18,14 +24,60 @@ class User(UserMixin):
         self.id = owner.id
         self.owner = owner
 
+    # Flask Login stores this id in the session. Including the owner's session generation means that bumping it (see
+    # logout below) invalidates every session issued before. Other processes running the app may still accept an old
+    # session until their cached User expires
+    def get_id(self):
+        return '{}:{}'.format(self.id, self.owner.session_generation)
+
 
 @login_manager.user_loader
-def user_loader(owner_id):
+def user_loader(user_id):
+    owner_id, _, generation = user_id.partition(':')
+    try:
+        return load_user(owner_id, int(generation))
+    except ValueError:
+        return None
+
+
+# Flask Login calls user_loader on every authenticated request, so cache the owner for a minute rather than making a
+# round trip to MongoDB each time
+user_cache = cachetools.TTLCache(maxsize=5000, ttl=60)
+user_cache_lock = threading.Lock()
+
+
+@cachetools.cached(user_cache, lock=user_cache_lock)
+def load_user(owner_id, generation):
     try:
         owner = Owner.objects.get(id=owner_id)
-        return User(owner)
     except DoesNotExist:
         return None
+    if owner.session_generation != generation:
+        return None
+    return User(owner)
+
+
+# The login and signup pages shown to logged out users on GET are the same every time, except for the form's CSRF token.
+# They are rendered once with a placeholder token, and later requests splice their own token into the cached HTML. The
+# cache is skipped in debug mode, so that changes to the templates show up
+CSRF_TOKEN_PLACEHOLDER = '__csrf_token_placeholder__'
+rendered_pages = {}
+
+
+def render_form_page(template, form):
+    cacheable = (not current_app.debug and request.method == 'GET' and 'csrf_token' in form
+                 and not current_user.is_authenticated and not session.get('_flashes'))
+    if not cacheable:
+        return render_template(template, form=form)
+
+    page = rendered_pages.get(template)
+    if page is None:
+        token = form.csrf_token.current_token
+        form.csrf_token.current_token = CSRF_TOKEN_PLACEHOLDER
+        page = render_template(template, form=form)
+        form.csrf_token.current_token = token
+        rendered_pages[template] = page
+    return page.replace(CSRF_TOKEN_PLACEHOLDER, form.csrf_token.current_token)
 
 
 # Signup creates a new user. Note that we store a HASH of the user's password - this is a common practice. On login,
@@ -37,13 +89,17 @@ def signup():
     form = SignupForm()
     if form.validate_on_submit():
         owner = Owner(username=form.username.data,
-                      pets=[],
                       joined_at=datetime.datetime.now(),
-                      hashed_password=generate_password_hash(form.password.data))
-        owner.save()
+                      hashed_password=hash_password(form.password.data))
+        try:
+            owner.save()
+        except NotUniqueError:
+            form.username.errors.append('Username already in use.')
+            return render_template('signup.html', form=form)
+        add_known_username(owner.username)
         flash('You have been signed up!')
         return redirect(url_for('.login'))
-    return render_template('signup.html', form=form)
+    return render_form_page('signup.html', form)
 
 @routes.route('/login', methods=['GET', 'POST'])
 def login():
@@ -51,23 +107,93 @@ def login():
     if form.validate_on_submit():
         try:
             owner = Owner.objects.get(username=form.username.data)
-            if check_password_hash(owner.hashed_password, form.password.data):
+            if verify_password(owner.hashed_password, form.password.data):
+                if needs_rehash(owner.hashed_password):
+                    Owner.objects(id=owner.id).update_one(
+                        set__hashed_password=hash_password(form.password.data))
                 user = User(owner)
                 login_user(user)
                 return "logged in"
         except DoesNotExist:
             pass
-    return render_template('login.html', form=form)
+    return render_form_page('login.html', form)
+
+@routes.route('/logout', methods=['GET'])
+@login_required
+def logout():
+    generation = current_user.owner.session_generation
+    Owner.objects(id=current_user.id).update_one(inc__session_generation=1)
+    with user_cache_lock:
+        user_cache.pop(cachetools.keys.hashkey(str(current_user.id), generation), None)
+    logout_user()
+    return "logged out"
+
+
+# Getting all the documents in a collection at once is usually not a good idea (too many), so these endpoints return
+# one page at a time. Pass ?limit= to choose the page size and ?after=<id of the last item on the previous page> to get
+# the next page. A limit which isn't an integer or an after which isn't an id is an HTTP 400 error
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+
+
+def paginate(queryset):
+    try:
+        limit = int(request.args.get('limit', DEFAULT_PAGE_SIZE))
+    except ValueError:
+        abort(400)
+    limit = min(max(limit, 1), MAX_PAGE_SIZE)
+    after = request.args.get('after')
+    if after is not None:
+        if not ObjectId.is_valid(after):
+            abort(400)
+        queryset = queryset(id__gt=after)
+    return queryset.order_by('id').limit(limit)
+
+
+# By default, responses are sent as newline delimited JSON (application/x-ndjson, one item per line), written while the
+# items are still being read from MongoDB. The client starts receiving data right away, and the page never has to be
+# held in memory as a whole
+#
+# http://ndjson.org/
+NDJSON_MIMETYPE = 'application/x-ndjson'
+
+
+def stream_ndjson(items):
+    def generate():
+        for item in items:
+            yield dumps(item) + b'\n'
+    return Response(stream_with_context(generate()), mimetype=NDJSON_MIMETYPE)
+
+
+# Other services can ask for BSON (MongoDB's own binary format) instead, by preferring application/bson over
+# application/x-ndjson in their Accept header. They get the documents exactly as MongoDB stores them, which skips
+# encoding NDJSON
+BSON_MIMETYPE = 'application/bson'
+
+
+def wants_bson():
+    return request.accept_mimetypes.best_match([NDJSON_MIMETYPE, BSON_MIMETYPE]) == BSON_MIMETYPE
+
+
+def bson_list(docs):
+    return Response(bson.encode({'items': list(docs)}), mimetype=BSON_MIMETYPE)
 
 
-# Getting all the documents in a collection is usually not a good idea (too many), but this is just provided to help you
-# explore the database through the API
 @routes.route('/owners', methods=['GET'])
 @login_required
 def get_all_owners():
-    # Owner.objects is an iterable that will iterate over all documents from the owner collection in MongoDB. We
-    # construct a list out of this iterable and convert it to json
-    return jsonify([o.to_dict() for o in Owner.objects])
+    # Calling only() tells MongoDB to send back just the fields we return, and as_pymongo() gives us the plain dicts
+    # returned by pymongo rather than turning each one into an Owner
+    owners = paginate(Owner.objects.only('id', 'username', 'joined_at')).as_pymongo()
+    if wants_bson():
+        return bson_list(owners)
+    owners = list(owners)
+
+    # The pets of all owners on this page are fetched with a single query, rather than one query per owner
+    pets = {}
+    for p in pets_of(o['_id'] for o in owners).only('id', 'owner_id').as_pymongo():
+        pets.setdefault(str(p['owner_id']), []).append(str(p['_id']))
+    return stream_ndjson(OwnerData.from_pymongo(o, pets.get(str(o['_id']), [])) for o in owners)
 
 
 @routes.route('/owners/<string:owner_id>', methods=['GET'])
@@ -79,19 +205,25 @@ def get_owner(owner_id):
     # https://docs.mongodb.com/manual/core/document/
     #
     # The get_or_404 method causes Flask to return an HTTP 404 response if the document could not be found
-    return Owner.objects.get_or_404(id=owner_id).to_dict()
+    owner = Owner.objects.get_or_404(id=owner_id)
+    return jsonify(owner.to_dict(owner.pet_ids()))
 
 
 @routes.route('/pets', methods=['GET'])
 @login_required
 def get_all_pets():
-    return jsonify([o.to_dict() for o in Pet.objects])
+    # no_cache stops MongoEngine from keeping every pet it has iterated over, and the pets are fetched from MongoDB 500
+    # at a time
+    pets = paginate(Pet.objects.no_cache().batch_size(500)).as_pymongo()
+    if wants_bson():
+        return bson_list(pets)
+    return stream_ndjson(PetData.from_pymongo(p) for p in pets)
 
 
 @routes.route('/pets/<string:pet_id>', methods=['GET'])
 @login_required
 def get_pet(pet_id):
-    return Pet.objects.get_or_404(id=pet_id).to_dict()
+    return jsonify(Pet.objects.get_or_404(id=pet_id))
 
 
 @routes.route('/pets', methods=['POST'])
@@ -99,30 +231,10 @@ def get_pet(pet_id):
 def create_pet():
     request_json = request.get_json()
 
-    # Get owner_id from the provided JWT token
-    owner_id = current_user.get_id()
-
-    # Get the current owner (throws exception if doesn't exist)
-    owner = Owner.objects.get(id=owner_id)
-
     # Create the new pet
     pet = Pet(name=request_json['name'],
               type=request_json['type'],
-              owner_id=owner_id)
+              owner_id=current_user.id)
     pet.save()
 
-    # Add the pet to the owner's list of pets and save the updated owner
-    owner.pets.append(str(pet.id))
-    owner.save()
-
-    # You might be familar with the concept of transactions. A transaction is
-    # a group of operations which must either all succeed or all fail - this
-    # preserves data consistency. In a production application, you could argue
-    # that this function should indeed perform a transaction with the database
-    # (which MongoDB supports).
-    #
-    # For our prototype, this might be overkill. You can explore transactions
-    # if you're interested.
-    #
-    # https://docs.mongodb.com/manual/core/transactions/
-    return pet.to_dict()
+    return jsonify(pet)
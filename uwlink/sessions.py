@@ -0,0 +1,79 @@
+import calendar
+import copy
+import hashlib
+import threading
+import time
+
+from cachetools import TTLCache
+from flask.sessions import SecureCookieSessionInterface
+from itsdangerous import BadSignature, URLSafeTimedSerializer
+
+# Flask Login keeps the logged in user's id in Flask's session, which is a signed cookie. Flask verifies the cookie's
+# HMAC signature and decodes its payload on every request, so all the @login_required endpoints pay for it
+#
+# This session interface remembers recently verified cookies for a short time. Cookies are keyed by a hash rather than
+# their raw value, and the session's max age is still checked on a cache hit
+#
+# Cookies are also remembered when they are issued, so the request right after logging in is already a cache hit
+#
+# https://flask.palletsprojects.com/en/1.1.x/api/#session-interface
+
+
+class CachedSessionInterface(SecureCookieSessionInterface):
+    def __init__(self, maxsize=10000, ttl=30):
+        self.cache = TTLCache(maxsize=maxsize, ttl=ttl)
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def cache_key(val):
+        return hashlib.blake2b(val.encode(), digest_size=16).digest()
+
+    def remember(self, val, data, signed_at):
+        with self.lock:
+            self.cache[self.cache_key(val)] = (copy.deepcopy(data), signed_at)
+
+    # Same as the serializer built by Flask, except that cookies are remembered as they are signed
+    def get_signing_serializer(self, app):
+        if not app.secret_key:
+            return None
+        signer_kwargs = dict(key_derivation=self.key_derivation, digest_method=self.digest_method)
+        return RememberingSerializer(app.secret_key, salt=self.salt, serializer=self.serializer,
+                                     signer_kwargs=signer_kwargs, remember=self.remember)
+
+    def open_session(self, app, request):
+        s = self.get_signing_serializer(app)
+        if s is None:
+            return None
+        val = request.cookies.get(app.session_cookie_name)
+        if not val:
+            return self.session_class()
+
+        max_age = app.permanent_session_lifetime.total_seconds()
+        key = self.cache_key(val)
+        with self.lock:
+            entry = self.cache.get(key)
+        if entry is not None:
+            data, signed_at = entry
+            if time.time() - signed_at <= max_age:
+                # Sessions are mutated in place (e.g. flashed messages), so never hand out the cached data itself
+                return self.session_class(copy.deepcopy(data))
+
+        try:
+            data, timestamp = s.loads(val, max_age=max_age, return_timestamp=True)
+        except BadSignature:
+            return self.session_class()
+
+        self.remember(val, data, calendar.timegm(timestamp.utctimetuple()))
+        return self.session_class(data)
+
+
+class RememberingSerializer(URLSafeTimedSerializer):
+    def __init__(self, *args, remember, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.remember = remember
+
+    def dumps(self, obj, salt=None):
+        val = super().dumps(obj, salt)
+        # itsdangerous timestamps have a resolution of one second
+        self.remember(val, obj, int(time.time()))
+        return val